@@ -1,6 +1,8 @@
 import taichi as ti
 import numpy as np
+import hashlib
 import math
+import os
 import warnings
 
 def _var_as_tuple(x, length):
@@ -42,16 +44,20 @@ def rand3():
 
 
 @ti.func
-def random_in_unit_sphere():
-    p = 2.0 * rand3() - ti.Vector([1, 1, 1])
-    while p.norm() >= 1.0:
-        p = 2.0 * rand3() - ti.Vector([1, 1, 1])
-    return p
+def random_unit_vector():
+    # Box-Muller; a normalized 3d standard normal is uniform on the sphere.
+    # 1 - ti.random() is in (0, 1], so log never sees 0
+    r1 = ti.sqrt(-2.0 * ti.log(1.0 - ti.random()))
+    r2 = ti.sqrt(-2.0 * ti.log(1.0 - ti.random()))
+    a1 = 2.0 * math.pi * ti.random()
+    a2 = 2.0 * math.pi * ti.random()
+    p = ti.Vector([r1 * ti.cos(a1), r1 * ti.sin(a1), r2 * ti.cos(a2)])
+    return p / ti.max(p.norm(), 1e-12)
 
 
 @ti.func
-def random_unit_vector():
-    return random_in_unit_sphere().normalized()
+def random_in_unit_sphere():
+    return random_unit_vector() * ti.pow(ti.random(), 1.0 / 3.0)
 
 
 @ti.func
@@ -87,84 +93,66 @@ M_fuzzy_metal = 5
 M_dielectric = 3
 M_diffuse = 4
 
+# capacity of the SphereSoup that Scene merges all Spheres into
+MAX_SPHERES = 64
+# a SphereSoup with at most this many spheres unrolls its intersection loop
+SPHERE_SOUP_UNROLL = 8
 
-@ti.data_oriented
-class Ray:
-    """A ray
-    ray equation: origin + t * direction
-    """
 
-    def __init__(self, origin, direction) -> None:
-        self.origin = origin
-        self.direction = direction / direction.norm()
+vec3 = ti.types.vector(3, ti.f32)
 
-    @ti.func
-    def at(self, t: float):
-        return self.origin + t * self.direction
+# A ray
+# ray equation: origin + t * direction
+Ray = ti.types.struct(origin=vec3, direction=vec3, inv_direction=vec3)
 
-    def __str__(self) -> str:
-        return f"Ray(start={self.origin}, dir={self.direction})"
+
+@ti.func
+def new_ray(origin, direction):
+    d = direction.normalized()
+    # for the slab test of boxes; keep it away from 0 to avoid 0 * inf
+    inv_d = 1.0 / ti.select(ti.abs(d) < 1e-30, 1e-30, d)
+    return Ray(origin=origin, direction=d, inv_direction=inv_d)
+
+
+@ti.func
+def ray_at(ray, t: float):
+    return ray.origin + t * ray.direction
 
 
 @ti.func
-def _sphere_hit(x, r, ray, time_min: float, time_max: float):
+def _sphere_hit(x, r2, ray, time_min: float, time_max: float):
     """ray sphere intersection.
     refernece:
     Fundamentals of Computer Graphics 4-th Edition, Chapter 4, section 4.4.1; page 76
-    """
-    is_hit = 0
-    hit_time = time_max
-    hit_point = ti.Vector([0.0, 0.0, 0.0])
-    hit_normal = ti.Vector([0.0, 1.0, 0.0])
-    is_inside = 0
 
+    - r2: radius * radius
+    """
     # the direction of ray is normed to 1
     oc = ray.origin - x
-
     doc = ray.direction.dot(oc)
 
-    t = doc * doc - (oc.dot(oc) - r * r)
-    # t < 0: no intersection
-    if t > time_min:  # have intersection
-        _t = ti.sqrt(t)
-        if _t < hit_time:
-            # - doc +/- sqrt(t)
-            t1 = -doc + _t
-            t2 = -doc - _t
-
-            if t1 < 0:
-                if t2 > 0:
-                    # ray is inside this sphere
-                    # ( <-- t1 - O-> --- t2 ---> )
-                    is_hit = 1
-                    hit_time = t2
-                    is_inside = 1
-                # else:  # no solution
-                #     # ( <--t2-- ) <-- t1 -- O->
-                #     print("no solution", t1, t2)
-            else:
-                if t2 > 0:
-                    # O-> -- t1 -->( --- t2 --> )
-                    # O-> -- t2 -->( --- t1 --> )
-                    is_hit = 1
-                    hit_time = ti.min(t1, t2)
-                else:
-                    # ray is inside this sphere
-                    # ( <-- t2 -- O-> -- t1 --> )
-                    is_hit = 1
-                    is_inside = 1
-                    hit_time = t2
-
-    # compute normal
-    if is_hit == 1:
-        hit_point = ray.at(hit_time)
-        if is_inside:
-            # normal vector is oppositive
-            hit_normal = (x - hit_point) / r
-        else:
-            hit_normal = (hit_point - x) / r
+    # disc < 0: no intersection
+    disc = doc * doc - (oc.dot(oc) - r2)
+    sqrt_disc = ti.sqrt(ti.max(disc, 0.0))
+    # - doc +/- sqrt(disc)
+    t_near = -doc - sqrt_disc
+    t_far = -doc + sqrt_disc
+
+    # the near one is behind: the ray is inside this sphere
+    # ( <-- t_near - O-> --- t_far ---> )
+    use_far = t_near < time_min
+    t = ti.select(use_far, t_far, t_near)
+    is_hit = (disc > 0.0) & (t > time_min) & (t < time_max)
+    is_inside = use_far & is_hit
+    hit_time = ti.select(is_hit, t, time_max)
 
-    return is_hit, hit_time, hit_point, hit_normal, is_inside
+    return is_hit, hit_time, is_inside
+
+
+@ti.func
+def _sphere_normal(x, r, hit_point, is_inside):
+    # normal vector is oppositive if inside
+    return ti.select(is_inside, -1.0, 1.0) / r * (hit_point - x)
 
 
 @ti.data_oriented
@@ -185,8 +173,10 @@ class Sphere:
         refernece:
         Fundamentals of Computer Graphics 4-th Edition, Chapter 4, section 4.4.1; page 76
         """
-        is_hit, hit_time, hit_point, hit_normal, is_inside = _sphere_hit(
-            self.center, self.radius, ray, time_min, time_max)
+        is_hit, hit_time, is_inside = _sphere_hit(
+            self.center, self.radius * self.radius, ray, time_min, time_max)
+        hit_point = ray_at(ray, hit_time)
+        hit_normal = _sphere_normal(self.center, self.radius, hit_point, is_inside)
 
         return is_hit, hit_time, hit_point, hit_normal, self.material, self.color, is_inside
 
@@ -227,7 +217,7 @@ class Plane:
             elif hit_time < time_max:
                 is_hit = 1
                 hit_normal = self.normal
-                hit_point = ray.at(hit_time)
+                hit_point = ray_at(ray, hit_time)
 
         return is_hit, hit_time, hit_point, hit_normal, self.material, self.color, is_inside
 
@@ -235,7 +225,6 @@ class Plane:
         return "Plane()"
 
 
-@ti.pyfunc
 def _parallelogram_init(a, x, b):
     """
     ```
@@ -244,149 +233,73 @@ def _parallelogram_init(a, x, b):
      /
     x --- b
     ```
-    """
-    ax = a - x
-    bx = b - x
-    normal = bx.cross(ax)
-    area = normal.norm()  # what is the norm is 0?
-    # assert area >= 1e-12, "not a parallelogram"
-    detidx = 0
-    idet = 0.0
-    if area < 1e-8:
-        # not a parallglogram
-        normal = ti.Vector([0.0, 0.0, 0.0])
-    else:
-        normal = normal / area
-
-        # | i     j     k     |
-        # | ax[0] ax[1] ax[2] |
-        # | bx[0] bx[1] bx[2] |
-        # try to compute its 2D determinant
-
-        det = ax[1] * bx[2] - ax[2] * bx[1]
-        if ti.abs(det) < 1e-8:
-            # previous det is too small; try another one
-            det = ax[0] * bx[2] - ax[2] * bx[0]
-            detidx = 1
-
-        if ti.abs(det) < 1e-8:
-            # previous dets are too small; try another one
-            det = ax[0] * bx[1] - ax[1] * bx[0]
-            detidx = 2
-
-        idet = 1.0 / det
+    a, x, b: numpy arrays of shape (N, 3); a batch of parallelograms
 
-    # assert(ti.abs(det) > 1e-8)  # "this could not happen, just in case"
-    return ax, bx, normal, area, detidx, idet
+    return ax, bx
+    """
+    return a - x, b - x
 
 
 @ti.func
-def _parallelogram_alpha_beta(px, ax, bx, idetidx, idet):
+def _moller_trumbore(ray, x, ax, bx):
     """
-    check point is in parallelogram; 
-    please convinced that this point is in the plane of this parallelogram.
-    p = x + alpha (a-x) + beta (b-x)
-    p - x = alpha (a-x) + beta (b-x)
-
-    px[0] = alpha ax[0] + beta bx[0]
-    px[1] = alpha ax[1] + beta bx[1]
-    px[2] = alpha ax[2] + beta bx[2]
-
-    detA0 = ax[1] bx[2] - ax[2] bx[1]
-    detA1 = ax[0] bx[2] - ax[2] bx[0]
-    detA2 = ax[0] bx[1] - ax[1] bx[0]
-
-    ```
-    | a b | -> inverse | d -c | 
-    | c d |            | -b a | / detA
-    ```
+    Moller-Trumbore ray triangle intersection, without the range checks;
+    p = x + alpha (a-x) + beta (b-x) = origin + t direction
 
-    if idetidx == 0:
-        alpha = 1/detA (px[0] ax[1] + px[1] ax[2])
-        beta  = 1/detA (px[0] bx[1] + px[1] bx[2])
-    if idetidx == 1:
-        alpha = 1/detA (px[0] ax[0] + px[1] ax[2])
-        beta  = 1/detA (px[0] bx[0] + px[1] bx[2])
-    if idetidx == 2:
-        alpha = 1/detA (px[0] ax[0] + px[1] ax[1])
-        beta  = 1/detA (px[0] bx[0] + px[1] bx[1])
+    return alpha, beta, t and a;
+    a = direction . ((b-x) x (a-x)); a > 0: the ray hits the back side
     """
-
-    alpha, beta = -1.0, -1.0
-
-    if idetidx == 0:  # a1 a2 | b1 b2
-        alpha = px[1] * bx[2] - px[2] * bx[1]
-        beta = px[2] * ax[1] - px[1] * ax[2]
-    elif idetidx == 1:  # a0 a2 | b0 b2
-        alpha = px[0] * bx[2] - px[2] * bx[0]
-        beta = px[2] * ax[0] - px[0] * ax[2]
-    else:  # 2 a0 a1 | b0 b1
-        alpha = px[0] * bx[1] - px[1] * bx[0]
-        beta = px[1] * ax[0] - px[0] * ax[1]
-
-    return alpha * idet, beta * idet
-
-# reference: https://stackoverflow.com/questions/2563849/ray-box-intersection-theory
-
-
-@ti.func
-def ray_intersect_solid_box_face(uhit, omin, omax, axis):
-    """
-    - uhit: [t * rx, t * ry, r * rz] hit point
-    - omin: [min.x, min.y, min.z]
-    - omax: [max.x, max.y, max.z]
-    - axis: the axis to ignore
-    """
-    ans = 1
-    for i in ti.static(range(3)):
-        if i != axis:
-            if uhit[i] < omin[i] or uhit[i] > omax[i]:
-                ans = 0
-    # return umin <= uhit and uhit <= umax and vmin <= vhit and vhit <= vmax
-    return ans
+    h = ray.direction.cross(bx)
+    a = ax.dot(h)
+    f = 1.0 / ti.select(ti.abs(a) < 1e-12, 1e-12, a)
+    s = ray.origin - x
+    alpha = f * s.dot(h)
+    q = s.cross(ax)
+    beta = f * ray.direction.dot(q)
+    t = f * bx.dot(q)
+    return alpha, beta, t, a
 
 
 @ti.func
 def ray_intersect_solid_box(ray, cmin, cmax, time_min: float, time_max: float):
     """
     intersect ray with solid box;
-    reference: Computer Graphic Book
-
-    ray hit the plane and hit point in the plane
+    slab test (Kay and Kajiya)
 
-    n (x - (o + t d)) = 0
-    => n (x - o) = t n d
-    n = ( 1, 0, 0), (0,  1, 0), (0, 0,  1)
-        (-1, 0, 0), (0, -1, 0), (0, 0, -1)
-    => ti = (x - o)[i] / d[i]
+    the ray hits the slab of axis i
+    between (cmin - o)[i] / d[i] and (cmax - o)[i] / d[i]
+    and hits the box if the intersection of the three intervals is not empty
     """
-
-    omin = cmin - ray.origin
-    omax = cmax - ray.origin
-
-    t = 0.0
-    tmin = time_max
-    for i in ti.static(range(3)):
-        rdi = ray.direction[i]
-        if rdi != 0:
-            t = omin[i] / rdi
-            if t > time_min and t < tmin:
-                hpoint = ray.at(t)
-                ishit = ray_intersect_solid_box_face(hpoint, cmin, cmax, i)
-                if ishit == 1:
-                    tmin = t
-
-            t = omax[i] / rdi
-            if t > time_min and t < tmin:
-                hpoint = ray.at(t)
-                ishit = ray_intersect_solid_box_face(hpoint, cmin, cmax, i)
-                if ishit == 1:
-                    tmin = t
+    t1 = (cmin - ray.origin) * ray.inv_direction
+    t2 = (cmax - ray.origin) * ray.inv_direction
+    tenter = ti.min(t1, t2).max()
+    texit = ti.max(t1, t2).min()
 
     is_hit = 0
-    if tmin > time_min and tmin < time_max:
+    if tenter <= texit and texit >= time_min and tenter <= time_max:
         is_hit = 1
-    return is_hit, tmin
+    return is_hit, ti.max(tenter, time_min)
+
+
+@ti.func
+def ray_intersect_solid_box_x8(ray, origin, scale, qmin, qmax, time_min: float, time_max: float):
+    """
+    intersect ray with the 8 child boxes of a wide node at once;
+    the same slab test as ray_intersect_solid_box
+
+    - origin, scale: the quantization grid of the node
+    - qmin, qmax: 8x3 matrix of the quantized corners, one row per child box;
+      cast from u8 by the caller
+    - return: hit mask and entry time of each child
+    """
+    is_hit = ti.Vector.zero(ti.i32, 8)
+    tenter = ti.Vector.zero(ti.f32, 8)
+    for k in range(8):  # not static; keeps the traversal small to compile
+        cmin = origin + scale * ti.Vector([qmin[k, 0], qmin[k, 1], qmin[k, 2]], ti.f32)
+        cmax = origin + scale * ti.Vector([qmax[k, 0], qmax[k, 1], qmax[k, 2]], ti.f32)
+        is_hit[k], tenter[k] = ray_intersect_solid_box(
+            ray, cmin, cmax, time_min, time_max)
+    return is_hit, tenter
 
 
 @ti.func
@@ -398,303 +311,334 @@ def solid_box_box_intersection(amin, amax, bmin, bmax):
     return ans
 
 
-class KDTreeNode:
+# optimal sorting network of 8 inputs (19 comparators)
+_SORT8_NETWORK = [
+    (0, 2), (1, 3), (4, 6), (5, 7),
+    (0, 4), (1, 5), (2, 6), (3, 7),
+    (0, 1), (2, 3), (4, 5), (6, 7),
+    (2, 4), (3, 5),
+    (1, 4), (3, 6),
+    (1, 2), (3, 4), (5, 6),
+]
+
+# size of the traversal stack of AABBTree
+BVH_STACK_SIZE = 32
+# cap of the visited nodes per ray, against runaway traversals
+BVH_MAX_ITERS = 256
+# SAH build of AABBTree
+BVH_SAH_BINS = 16
+# relative to one triangle test; a node tests 8 boxes at once, near the
+# cost of one triangle. Lower values split down to 1-2 triangle leaves
+BVH_SAH_TRAVERSAL_COST = 1.0
+BVH_MAX_LEAF = 8  # at most 8; the count is stored in 3 bits
+# margin of the quantized boxes, relative to |origin| + scale * q: about
+# 2 f32 ulp, more than the rounding of origin + scale * q in the traversal
+BVH_QUANT_MARGIN = 2.4e-7
+# on-disk cache of the built AABBTree, keyed by the triangles; None: disabled
+BVH_CACHE_DIR = ".bvh_cache"
+# bump it when the build or the layout of [octree] changes
+BVH_CACHE_VERSION = 4
+
+
+class AABBTreeNode:
     def __init__(self) -> None:
-        self.items = None
         self.cmin = None
         self.cmax = None
         self.left = None
-        self.mid = None
         self.right = None
-        self.lritems = None
-
-
-@ti.data_oriented
-class KDTree:
-    """KD Tree; only works for TriangleSoup and ParallelogramSoup
+        # range of the triangles [first, first + count)
+        # in the sorted order (AABBTree.indices)
+        self.first = -1
+        self.count = 0
+
+    def is_leaf(self):
+        return self.left is None
+
+    def surface_area(self):
+        d = self.cmax - self.cmin
+        return d[0] * d[1] + d[1] * d[2] + d[2] * d[0]
+
+
+class AABBTree:
+    """AABB Tree (BVH); only works for TriangleSoup and ParallelogramSoup
+
+    The tree is built as a binary tree with the binned surface area
+    heuristic (SAH), and then collapsed into 8-wide nodes when it is
+    flattened to taichi.
+
+    The build only works on numpy arrays; the triangles are sorted in
+    place (indices), so that every sub tree is a range of the triangles.
+    The owner should reorder its triangles by indices.
+
+    [octree]
+    - origin, scale: 3, the quantization grid of the node
+    - qmin: 8x3 u8, min corner of the 8 children; cmin = origin + scale * qmin
+    - qmax: 8x3 u8, max corner of the 8 children; cmax = origin + scale * qmax
+    - subn: 8, the children
+        - subn > 0: index of the child node
+        - subn < 0: leaf; -subn - 1 = (first << 3) | (count - 1),
+          the triangles [first, first + count) in the sorted order
+        - subn = 0: empty slot
     """
 
     def __init__(self, meshes) -> None:
-        self.count = meshes.shape[0]
-        self.meshes = meshes
+        """
+        - meshes: dict of numpy arrays (x, ax, bx, ...); see TriangleSoup._init_meshes
+        """
+        x = meshes["x"]
+        a = meshes["ax"] + x  # ax = a - x
+        b = meshes["bx"] + x  # bx = b - x
+
+        self.count = x.shape[0]
         self.root = None
+        self.depth = 0
+        self.node_cmin = None
+        self.node_cmax = None
+        self.node_subn = None
         # cmin, cmax
-        self.meshboxes = ti.Vector.field(3, ti.f32, (self.count, 2))
-        self._compute_obj_boxes()
+        self.boxes = np.stack([
+            np.minimum(np.minimum(x, a), b),
+            np.maximum(np.maximum(x, a), b)], axis=1)
+        self.centers = 0.5 * (self.boxes[:, 0] + self.boxes[:, 1])
+        self.indices = np.arange(self.count, dtype=np.int32)
 
     def build_tree(self):
         if self.count <= 0:
             return
-        self.root = self._split_kd([i for i in range(self.count)], 0, 128)
-
-    def flat_tree_to_taichi(self, kdflat, kdcmin, kdcmax):
-        self._flat_tree_to_taichi(kdflat, kdcmin, kdcmax, 0, 0, self.root)
-        # kdcmin[0] = self.root.cmin
-        # kdcmax[0] = self.root.cmax
-        # kdflat[0] = 0
-        # kdflat[1] = -1
-        # kdflat[2] = self.count
-        # for i in range(self.count):
-        #     kdflat[3+i] = i
-
-    def _flat_tree_to_taichi(self, kdflat, kdcmin, kdcmax, fidx, cidx, root):
-        if root is None:
-            # write -1, 0 to kdflat
-            kdcmin[cidx] = ti.Vector([0.0, 0.0, 0.0])
-            kdcmax[cidx] = ti.Vector([0.0, 0.0, 0.0])
-            kdflat[fidx] = cidx
-            kdflat[fidx + 1] = -1
-            kdflat[fidx + 2] = 0
-            return 3, 1
-
-        # [kdflat]
-        # 0: corner index;
-        # 1: mark
-        # if mark >= 0:
-        #   1: left index
-        #   2: right index
-        #   3: mid index
-        #   4： lr data index
-        # else:
-        #   2: data len (n)
-        #   3+0: triangle index 0
-        #   3+1: triangle index 1
-        #   ...: .....
-        #   3+n-1: triangle index n-1
-        #
-        # next block
-
-        kdcmin[cidx] = root.cmin
-        kdcmax[cidx] = root.cmax
-        kdflat[fidx] = cidx
-
-        fadd, cadd = 1, 1
-
-        if root.items is None:  # have childs
-            fadd += 4  # left right mid, lrdata
-            for i, child in enumerate([root.left, root.right, root.mid]):
-                kdflat[fidx + 1 + i] = fidx + fadd
-                _dxf, _dxc = self._flat_tree_to_taichi(
-                    kdflat, kdcmin, kdcmax, fidx + fadd, cidx + cadd, child)
-                fadd += _dxf
-                cadd += _dxc
-
-            kdflat[fidx + 1 + 3] = fidx + fadd
-            kdflat[fidx + fadd] = cidx  # use the same box as root
-            fadd += 1
-            kdflat[fidx + fadd] = -1
-            fadd += 1
-            # data len
-            kdflat[fidx + fadd] = len(root.lritems)
-            fadd += 1
-            for i in root.lritems:
-                kdflat[fidx + fadd] = i
-                fadd += 1
-        else:
-            # write to kdflat
-            # left index set to self; no more left node
-            kdflat[fidx + fadd] = -1
-            fadd += 1
-            # data length
-            kdflat[fidx + fadd] = len(root.items)
-            fadd += 1
-            for i in root.items:
-                kdflat[fidx + fadd] = i
-                fadd += 1
-
-        return fadd, cadd
-
-    @ti.kernel
-    def _compute_obj_boxes(self):
-        # num faces is self.count <- static alert
-        for i in range(self.count):
-            di = self.meshes[i]
-            x = di.x
-            a = di.ax + x  # ax = a - x
-            b = di.bx + x  # bx = b - x
-
-            for j in ti.static(range(3)):
-                self.meshboxes[i, 0][j] = min(x[j], a[j], b[j])
-                self.meshboxes[i, 1][j] = max(x[j], a[j], b[j])
-
-    @ti.kernel
-    def _compute_box(self, cmm: ti.any_arr(), indexes: ti.any_arr()):
-
-        # init
-        cmin = ti.Vector([0.0, 0.0, 0.0])
-        cmax = ti.Vector([0.0, 0.0, 0.0])
+        self.root = self.split_aabb()
+        self.depth = 0
+        self._flat_tree(self.root)
 
-        for i in indexes:
-            ii = indexes[i]
-            di = self.meshes[ii]
-            x = di.x
-            a = di.ax + x  # ax = a - x
-            b = di.bx + x  # bx - b - x
-
-            for j in ti.static(range(3)):
-                _cmin = min(x[j], a[j], b[j])
-                _cmax = max(x[j], a[j], b[j])
-                ti.atomic_min(cmin[j], _cmin)
-                ti.atomic_max(cmax[j], _cmax)
-
-        # cmm: cmin, cmax, size var
-        cmm[0] = cmin
-        cmm[1] = cmax
+    def split_aabb(self):
+        """top-down build with an explicit stack of [left, right) ranges
+        of self.indices
+        """
+        root = AABBTreeNode()
+        stack = [(root, 0, self.count)]
+
+        while len(stack) > 0:
+            node, left, right = stack.pop()
+            objlist = self.indices[left:right]  # a view; sorted in place
+            node.cmin = self.boxes[objlist, 0].min(axis=0)
+            node.cmax = self.boxes[objlist, 1].max(axis=0)
+
+            nleft = self._split_sah(node, objlist)
+            if nleft == 0:
+                node.first = left
+                node.count = right - left
+                continue
 
-    @ti.kernel
-    def _align_kd_box(
-            self,
-            dst: ti.any_arr(),
-            objlist: ti.any_arr(),
-            axis: ti.i32,
-            left: ti.f32,
-            mx: ti.f32,
-            right: ti.f32):
-        # 0; not left nor right
-        # 1: left
-        # 2: right
-        # 3: left and right
-
-        for i in objlist:
-            # cmin, cmax, center
-            obox0 = 0.0
-            obox1 = 0.0
-            for j in ti.static(range(3)):
-                if j == axis:
-                    obox0 = self.meshboxes[objlist[i], 0][j]
-                    obox1 = self.meshboxes[objlist[i], 1][j]
-            _t = 0
-            if max(left, obox0) <= min(obox1, mx):
-                _t += 1
-            if max(mx, obox0) <= min(obox1, right):
-                _t += 2
-
-            dst[i] = _t
-
-    def _split_kd(self, objlist: list, depth, max_depth=128):
-        # print("_split_oct", left, right)
-        # (left, right]
-
-        objlen = len(objlist)
-        objlist = np.asarray(objlist, dtype=np.int32)
-
-        if len(objlist) == 0:
-            return None
-
-        root = KDTreeNode()
-        # cmm: cmin, cmax, size var
-        cmm = ti.Vector.ndarray(3, ti.f32, shape=(2,))
-        self._compute_box(cmm, objlist)
-        root.cmin = cmm[0]
-        root.cmax = cmm[1]
-
-        if objlen < 16 or depth >= max_depth:
-            root.items = objlist
-            return root
-
-        # the axis of max size
-
-        dst = ti.ndarray(ti.i32, objlen)
-
-        mx0, cnt0 = self.search_split_line(objlist, 0, cmm)
-        mx1, cnt1 = self.search_split_line(objlist, 1, cmm)
-        mx2, cnt2 = self.search_split_line(objlist, 2, cmm)
-        
-        if cnt0 < cnt1:
-            if cnt0 < cnt2:  # 0 < 1; 0 < 2
-                axis = 0
-                mx = mx0
-            else:  # 2 < 0; 0 < 1;
-                axis = 2
-                mx = mx2
-        else:  # 1 < 0
-            if cnt1 < cnt2:  # 1 < 0; 1 < 2
-                axis = 1
-                mx = mx1
-            else:  # 2 < 1; 1 < 0;
-                axis = 2
-                mx = mx2
-
-        ll = float(cmm[0][axis])
-        rr = float(cmm[1][axis])
-
-        self._align_kd_box(dst, objlist, axis, ll, mx, rr)
-
-        left = []
-        right = []
-        mid = []
-        for i in range(objlen):
-            if dst[i] == 1:
-                left.append(objlist[i])
-            elif dst[i] == 2:
-                right.append(objlist[i])
-            elif dst[i] == 3:
-                mid.append(objlist[i])
-
-        if len(mid) == objlen:
-            # all is in the left
-            root.items = objlist
-            return root
-
-        root.mid = self._split_kd(mid, depth+1, depth+1)  # max depth = depth
-        root.left = self._split_kd(left, depth+1, max_depth)
-        root.right = self._split_kd(right, depth+1, max_depth)
-        root.lritems = np.asarray(left + right, dtype=np.int32)
+            node.left = AABBTreeNode()
+            node.right = AABBTreeNode()
+            stack.append((node.right, left + nleft, right))
+            stack.append((node.left, left, left + nleft))
 
         return root
 
-    def search_split_line(self, objlist: np.ndarray, axis: int, cmm):
+    def _split_sah(self, node, objlist: np.ndarray):
+        """find the split of objlist with the lowest SAH cost
+        cost = C_trav + (SA_L * n_L + SA_R * n_R) / SA
+        and sort objlist in place (left part first);
+
+        return the size of the left part, or 0 if a leaf is cheaper
         """
-        grid search split line along axis
+        n = objlist.shape[0]
+        if n == 1:
+            return 0
+
+        d = node.cmax - node.cmin
+        area = max(d[0] * d[1] + d[1] * d[2] + d[2] * d[0], 1e-12)
+        # a leaf costs n; larger leaves are always split
+        best_cost = float(n) if n <= BVH_MAX_LEAF else np.inf
+        best_axis, best_k = -1, -1
+        best_bins = None
+
+        boxes = self.boxes[objlist]
+        centers = self.centers[objlist]
+        ccmin = centers.min(axis=0)
+        extent = centers.max(axis=0) - ccmin
+
+        for axis in range(3):
+            if extent[axis] <= 0:
+                continue
+            bins = ((centers[:, axis] - ccmin[axis]) *
+                    (BVH_SAH_BINS / extent[axis])).astype(np.int32)
+            bins = np.minimum(bins, BVH_SAH_BINS - 1)
+
+            bcnt = np.bincount(bins, minlength=BVH_SAH_BINS)
+            bmin = np.full((BVH_SAH_BINS, 3), np.inf, dtype=np.float32)
+            bmax = np.full((BVH_SAH_BINS, 3), -np.inf, dtype=np.float32)
+            np.minimum.at(bmin, bins, boxes[:, 0])
+            np.maximum.at(bmax, bins, boxes[:, 1])
+
+            # split after bin k; the first and the last bins are never empty
+            lcnt = np.cumsum(bcnt)[:-1]
+            rcnt = np.cumsum(bcnt[::-1])[::-1][1:]
+            ld = np.maximum.accumulate(bmax)[:-1] - np.minimum.accumulate(bmin)[:-1]
+            rd = (np.maximum.accumulate(bmax[::-1])[::-1] -
+                  np.minimum.accumulate(bmin[::-1])[::-1])[1:]
+            larea = ld[:, 0] * ld[:, 1] + ld[:, 1] * ld[:, 2] + ld[:, 2] * ld[:, 0]
+            rarea = rd[:, 0] * rd[:, 1] + rd[:, 1] * rd[:, 2] + rd[:, 2] * rd[:, 0]
+            # empty bins in the middle give the same split as their neighbour
+            cost = BVH_SAH_TRAVERSAL_COST + (larea * lcnt + rarea * rcnt) / area
+
+            k = int(np.argmin(cost))
+            if cost[k] < best_cost:
+                best_cost, best_axis, best_k = float(cost[k]), axis, k
+                best_bins = bins
+
+        if best_axis < 0:
+            if n <= BVH_MAX_LEAF:
+                return 0
+            # all centers are the same; split by half
+            return n // 2
+
+        mask = best_bins <= best_k
+        objlist[:] = np.concatenate([objlist[mask], objlist[~mask]])
+        return int(mask.sum())
+
+    def _collapse(self, root):
+        """collapse the binary sub-tree of root into (at most) 8 children;
+        always open the child with the largest surface area
         """
-        best_mx = 0.0
-        best_cnt = objlist.shape[0]
-        ll = float(cmm[0][axis])
-        rr = float(cmm[1][axis])
-
-        alpha = 0.0
-
-        while alpha < 1.0:
-            mx = alpha * ll + (1.0 - alpha) * rr
-            cnt = self._kd_box_count_x(objlist, axis, ll, mx, rr)
-            if cnt < best_cnt:
-                best_mx = mx
-                best_cnt = cnt
-            alpha += 0.05
+        if root.is_leaf():
+            return [root]
+
+        children = [root.left, root.right]
+        while len(children) < 8:
+            best, best_area = -1, -1.0
+            for i, child in enumerate(children):
+                if not child.is_leaf() and child.surface_area() > best_area:
+                    best, best_area = i, child.surface_area()
+            if best < 0:  # all are leaves
+                break
+            child = children.pop(best)
+            children.append(child.left)
+            children.append(child.right)
+        return children
+
+    def _flat_tree(self, root):
+        """flatten the binary tree into 8-wide nodes, breadth first;
+        fill node_cmin (N, 8, 3), node_cmax (N, 8, 3) and node_subn (N, 8)
+        """
+        queue = [(root, 1)]
+        cmin, cmax, subn, depths = [], [], [], []
+        nidx = 0
+        while nidx < len(queue):
+            node, depth = queue[nidx]
+            self.depth = max(self.depth, depth)
+            depths.append(depth)
+            children = self._collapse(node)
+            cmin.append(np.zeros((8, 3), dtype=np.float32))
+            cmax.append(np.zeros((8, 3), dtype=np.float32))
+            subn.append(np.zeros((8,), dtype=np.int32))
+
+            for i, child in enumerate(children):
+                cmin[nidx][i] = child.cmin
+                cmax[nidx][i] = child.cmax
+                if child.is_leaf():
+                    subn[nidx][i] = -((child.first << 3) | (child.count - 1)) - 1
+                else:
+                    subn[nidx][i] = len(queue)
+                    queue.append((child, depth + 1))
+            nidx += 1
 
-        return best_mx, best_cnt
+        self.node_cmin = np.stack(cmin)
+        self.node_cmax = np.stack(cmax)
+        self.node_subn = np.stack(subn)
+        # breadth first: the nodes of a level are [levels[d], levels[d + 1])
+        self.levels = np.searchsorted(
+            depths, np.arange(1, self.depth + 2)).astype(np.int32)
 
-    @ti.kernel
-    def _kd_box_count_x(
-            self,
-            objlist: ti.any_arr(),
-            axis: ti.i32,
-            left: ti.f32,
-            mx: ti.f32,
-            right: ti.f32) -> ti.f32:
-        lcnt = 0.0
-        rcnt = 0.0
-        mcnt = 0.0
-        for i in objlist:
-            # cmin, cmax, center
-            obox0 = 0.0
-            obox1 = 0.0
-            for j in ti.static(range(3)):
-                if j == axis:
-                    obox0 = self.meshboxes[objlist[i], 0][j]
-                    obox1 = self.meshboxes[objlist[i], 1][j]
-            hL = max(left, obox0) <= min(obox1, mx)
-            hR = max(mx, obox0) <= min(obox1, right)
-
-            if hL and hR:
-                mcnt += 1.0
-            elif hL:
-                lcnt += 1.0
-            else:
-                rcnt += 1.0
-
-        # just guess
-        return abs(lcnt - rcnt) + 0.5 * mcnt
+    @staticmethod
+    def _quantize(cmin, cmax, valid):
+        """quantize the child boxes (N, 8, 3) of the nodes to u8; the
+        dequantized boxes always contain the original ones
+        """
+        origin = np.where(valid[..., None], cmin, np.inf).min(axis=1)
+        extent = np.where(valid[..., None], cmax, -np.inf).max(axis=1) - origin
+        # a bit larger, so that qmax = 255 covers the top after rounding
+        scale = (np.maximum(extent, 1e-30) * (1.0 + 1e-5) / 255.0).astype(np.float32)
+        origin, scale = origin[:, None], scale[:, None]
+
+        qmin = np.floor((cmin - origin) / scale)
+        qmax = np.ceil((cmax - origin) / scale)
+        # one more step if origin + scale * q is not BVH_QUANT_MARGIN on the
+        # right side; the traversal may round it differently, e.g. with fma
+        qmin -= origin + scale * qmin > cmin - BVH_QUANT_MARGIN * (np.abs(origin) + scale * qmin)
+        qmax += origin + scale * qmax < cmax + BVH_QUANT_MARGIN * (np.abs(origin) + scale * qmax)
+        qmin = np.where(valid[..., None], np.clip(qmin, 0, 255), 0)
+        qmax = np.where(valid[..., None], np.clip(qmax, 0, 255), 0)
+        return origin[:, 0], scale[:, 0], qmin.astype(np.uint8), qmax.astype(np.uint8)
+
+    def to_numpy(self):
+        """the [octree] as a dict of numpy arrays; with the triangle order
+        (indices), the root box (bbox), the depth and the levels
+        """
+        origin, scale, qmin, qmax = self._quantize(
+            self.node_cmin, self.node_cmax, self.node_subn != 0)
+        return {
+            "indices": self.indices,
+            "bbox": np.stack([self.root.cmin, self.root.cmax]).astype(np.float32),
+            "depth": np.int32(self.depth),
+            "levels": self.levels,
+            "origin": origin,
+            "scale": scale,
+            "qmin": qmin,
+            "qmax": qmax,
+            "subn": self.node_subn,
+        }
+
+
+def _bvh_stack_need(subn):
+    """the most entries the traversal stack of ray_intersect can hold for
+    the 8-wide nodes subn (N, 8), breadth first; a node is popped before
+    its inner children are pushed
+    """
+    inner = subn > 0
+    pushes = inner.sum(axis=1)
+    # stack entries below node n while it is visited
+    below = np.zeros(subn.shape[0], dtype=np.int64)
+    for n in range(subn.shape[0]):
+        below[subn[n][inner[n]]] = below[n] + pushes[n] - 1
+    return int((below + pushes).max())
+
+
+def _bvh_cache_path(meshes):
+    if BVH_CACHE_DIR is None:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{BVH_CACHE_VERSION} {BVH_SAH_BINS} {BVH_SAH_TRAVERSAL_COST} {BVH_MAX_LEAF}".encode())
+    for k in ("x", "ax", "bx"):
+        h.update(np.ascontiguousarray(meshes[k]).tobytes())
+    return os.path.join(BVH_CACHE_DIR, h.hexdigest() + ".npz")
+
+
+def _load_bvh_cache(meshes):
+    """the cached AABBTree.to_numpy() of meshes, or None"""
+    path = _bvh_cache_path(meshes)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {k: data[k] for k in data.files}
+    except (OSError, ValueError):
+        warnings.warn(f"ignore broken bvh cache {path}")
+        return None
+
+
+def _save_bvh_cache(meshes, tree):
+    path = _bvh_cache_path(meshes)
+    if path is None:
+        return
+    try:
+        os.makedirs(BVH_CACHE_DIR, exist_ok=True)
+        # write then rename; never leave a half written cache
+        with open(path + ".tmp", "wb") as f:
+            np.savez_compressed(f, **tree)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        warnings.warn(f"cannot write bvh cache {path}: {e}")
 
 
 @ti.data_oriented
@@ -715,6 +659,9 @@ class TriangleSoup:
     - faces: the faces
     - matrial: material
     - texture: texture map is needed to be rotated by -pi/2 (-90 degree)
+
+    The triangles are stored in an 8-wide AABB tree; its traversal stack is
+    a local vector, so `ti.init(dynamic_index=True)` is needed.
     """
 
     def __init__(self, vertex, faces, material=M_unknown, texture=None, color=None) -> None:
@@ -745,103 +692,183 @@ class TriangleSoup:
 
         self.count = self.faces.shape[0]
 
+        # SOA: a leaf reads a range of x, ax and bx; the normal is computed
+        # only for the hit
         self.meshes = ti.Struct.field({
             "x": ti.types.vector(3, ti.f32),
             "ax": ti.types.vector(3, ti.f32),
             "bx": ti.types.vector(3, ti.f32),
-            "n": ti.types.vector(3, ti.f32),
-            "idetidx": ti.i32,
-            "idet": ti.f32,
-        }, self.count)
+        }, self.count, layout=ti.Layout.SOA)
 
         self.material = material
 
-        # [kdflat]
-        # 0: corner index;
-        # 1: mark
-        # if mark >= 0:
-        #   1: left index
-        #   2: right index
-        #   3: mid index
-        #   4： lr data index
-        # else:
-        #   2: data len (n)
-        #   3+0: triangle index 0
-        #   3+1: triangle index 1
-        #   ...: .....
-        #   3+n-1: triangle index n-1
-        #
-        # next block
-        self.kdflat = ti.field(ti.i32)
-        ti.root.pointer(ti.i, int(np.ceil(self.count*self.count / 64)))\
-            .dense(ti.i, 64).place(self.kdflat)
-        self.kdcmin = ti.Vector.field(3, ti.f32)
-        self.kdcmax = ti.Vector.field(3, ti.f32)
-        ti.root.pointer(ti.i, int(np.ceil(2*self.count / 64)))\
-            .dense(ti.i, 64).place(self.kdcmin, self.kdcmax)
-
-        self._init_meshes(self.count)
-        self.build_tree()
+        # root box of all the triangles; [octree] is allocated by build_tree
+        self.bbox = ti.Vector.field(3, ti.f32, 2)
+        self.octree = None
+        self.levels = []
+        # unquantized child boxes of [octree]; allocated by refit
+        self.octree_cmin = None
+        self.octree_cmax = None
 
-    @ti.kernel
-    def _init_meshes(self, n: int):
-        for i in range(n):
-            p0, p1, p2 = self.faces[i, 0], self.faces[i, 1], self.faces[i, 2]
-            a = ti.Vector(
-                [self.vertex[p0, 0], self.vertex[p0, 1], self.vertex[p0, 2]])
-            x = ti.Vector(
-                [self.vertex[p1, 0], self.vertex[p1, 1], self.vertex[p1, 2]])
-            b = ti.Vector(
-                [self.vertex[p2, 0], self.vertex[p2, 1], self.vertex[p2, 2]])
-
-            info = _parallelogram_init(a, x, b)
-            # ax, bx, normal, area, detidx, idet
-
-            # print("mesh", i, info[2], info[4], info[5])
-
-            self.meshes[i].x = x
-            self.meshes[i].ax = info[0]
-            self.meshes[i].bx = info[1]
-            self.meshes[i].n = info[2]
-            self.meshes[i].idetidx = info[4]
-            self.meshes[i].idet = info[5]
+        self.build_tree(self._init_meshes(vertex, faces), faces)
 
-    def build_tree(self):
+    @staticmethod
+    def _init_meshes(vertex, faces):
+        """the meshes (see self.meshes) of all faces, as numpy arrays"""
+        vertex = np.asarray(vertex[:, :3], np.float64)
+        faces = np.asarray(faces)
+        a = vertex[faces[:, 0]]
+        x = vertex[faces[:, 1]]
+        b = vertex[faces[:, 2]]
+        ax, bx = _parallelogram_init(a, x, b)
+        return {
+            "x": x.astype(np.float32),
+            "ax": ax.astype(np.float32),
+            "bx": bx.astype(np.float32),
+        }
+
+    def build_tree(self, meshes, faces):
+        """build the tree of meshes (dict of numpy arrays), then sort and
+        upload them to self.meshes, and faces (numpy array) to self.faces
+        """
         print("start build tree")
-        octt = KDTree(self.meshes)
-        octt.build_tree()
-        octt.flat_tree_to_taichi(self.kdflat, self.kdcmin, self.kdcmax)
-        self.dump_tree()
-        # print(self.meshes)
-        del octt
+        tree = _load_bvh_cache(meshes)
+        if tree is None:
+            octt = AABBTree(meshes)
+            octt.build_tree()
+            tree = octt.to_numpy()
+            del octt
+            _save_bvh_cache(meshes, tree)
+
+        # sort the triangles; the leaves of a sub tree are neighbours
+        order = tree["indices"]
+        self.meshes.from_numpy({k: v[order] for k, v in meshes.items()})
+        self.faces.from_numpy(np.asarray(faces)[order])
+
+        self.octree = ti.Struct.field({
+            "origin": ti.types.vector(3, ti.f32),
+            "scale": ti.types.vector(3, ti.f32),
+            "qmin": ti.types.matrix(8, 3, ti.u8),
+            "qmax": ti.types.matrix(8, 3, ti.u8),
+            "subn": ti.types.vector(8, ti.i32),
+        }, shape=tree["subn"].shape[0])
+        self.octree.origin.from_numpy(tree["origin"])
+        self.octree.scale.from_numpy(tree["scale"])
+        self.octree.subn.from_numpy(tree["subn"])
+        self.octree.qmin.from_numpy(tree["qmin"])
+        self.octree.qmax.from_numpy(tree["qmax"])
+        self.bbox.from_numpy(tree["bbox"])
+        self.levels = tree["levels"].tolist()
+        need = _bvh_stack_need(tree["subn"])
+        if need > BVH_STACK_SIZE:
+            warnings.warn(f"AABBTree may need {need} traversal stack entries, "
+                          f"more than BVH_STACK_SIZE = {BVH_STACK_SIZE}")
         print("end build tree")
-        # exit(0)
+
+    def update_vertex(self, vertex):
+        """move the vertex and refit the tree; the faces are unchanged"""
+        vertex = np.asarray(vertex, dtype=np.float32)
+        self.vertex.from_numpy(vertex)
+        self.meshes.from_numpy(self._init_meshes(vertex, self.faces.to_numpy()))
+        self.refit()
+
+    def refit(self):
+        """recompute the boxes of the tree from self.meshes bottom-up,
+        keeping its topology; one parallel kernel per level
+        """
+        if self.octree_cmin is None:
+            self.octree_cmin = ti.Vector.field(3, ti.f32, (self.octree.shape[0], 8))
+            self.octree_cmax = ti.Vector.field(3, ti.f32, (self.octree.shape[0], 8))
+        self._refit_leaves()
+        for d in reversed(range(len(self.levels) - 1)):
+            self._refit_level(self.levels[d], self.levels[d + 1])
+        self._refit_quantize()
+
+    @ti.kernel
+    def _refit_leaves(self):
+        ti.loop_config(serialize=False)
+        for node, k in self.octree_cmin:
+            subn = self.octree[node].subn[k]
+            if subn < 0:
+                first = (-subn - 1) >> 3
+                count = ((-subn - 1) & 7) + 1
+                cmin = ti.Vector([1e30, 1e30, 1e30])
+                cmax = ti.Vector([-1e30, -1e30, -1e30])
+                for i in range(first, first + count):
+                    item = self.meshes[i]
+                    cmin = ti.min(cmin, item.x, item.x + item.ax, item.x + item.bx)
+                    cmax = ti.max(cmax, item.x, item.x + item.ax, item.x + item.bx)
+                self.octree_cmin[node, k] = cmin
+                self.octree_cmax[node, k] = cmax
+
+    @ti.kernel
+    def _refit_level(self, begin: int, end: int):
+        # the children are in the deeper levels, which are done
+        ti.loop_config(serialize=False)
+        for node, k in ti.ndrange((begin, end), 8):
+            child = self.octree[node].subn[k]
+            if child > 0:
+                cmin = ti.Vector([1e30, 1e30, 1e30])
+                cmax = ti.Vector([-1e30, -1e30, -1e30])
+                for j in range(8):
+                    if self.octree[child].subn[j] != 0:
+                        cmin = ti.min(cmin, self.octree_cmin[child, j])
+                        cmax = ti.max(cmax, self.octree_cmax[child, j])
+                self.octree_cmin[node, k] = cmin
+                self.octree_cmax[node, k] = cmax
+
+    @ti.kernel
+    def _refit_quantize(self):
+        # the same rounding and margin as AABBTree._quantize
+        ti.loop_config(serialize=False)
+        for node in self.octree:
+            subn = self.octree[node].subn
+            origin = ti.Vector([1e30, 1e30, 1e30])
+            top = ti.Vector([-1e30, -1e30, -1e30])
+            for k in range(8):
+                if subn[k] != 0:
+                    origin = ti.min(origin, self.octree_cmin[node, k])
+                    top = ti.max(top, self.octree_cmax[node, k])
+            scale = ti.max(top - origin, 1e-30) * (1.0 + 1e-5) / 255.0
+            self.octree[node].origin = origin
+            self.octree[node].scale = scale
+            if node == 0:
+                self.bbox[0] = origin
+                self.bbox[1] = top
+
+            for k in range(8):
+                qmin = ti.Vector([0.0, 0.0, 0.0])
+                qmax = ti.Vector([0.0, 0.0, 0.0])
+                if subn[k] != 0:
+                    cmin = self.octree_cmin[node, k]
+                    cmax = self.octree_cmax[node, k]
+                    qmin = ti.floor((cmin - origin) / scale)
+                    qmax = ti.ceil((cmax - origin) / scale)
+                    qmin -= ti.select(origin + scale * qmin > cmin - BVH_QUANT_MARGIN * (ti.abs(origin) + scale * qmin),
+                                      1.0, 0.0)
+                    qmax += ti.select(origin + scale * qmax < cmax + BVH_QUANT_MARGIN * (ti.abs(origin) + scale * qmax),
+                                      1.0, 0.0)
+                    qmin = ti.min(ti.max(qmin, 0.0), 255.0)
+                    qmax = ti.min(ti.max(qmax, 0.0), 255.0)
+                for i in ti.static(range(3)):
+                    self.octree[node].qmin[k, i] = ti.cast(qmin[i], ti.u8)
+                    self.octree[node].qmax[k, i] = ti.cast(qmax[i], ti.u8)
 
     def dump_tree(self):
         nlist = [(0, 'O')]
-        # print(self.kdflat)
         while len(nlist) > 0:
             idx, tag = nlist.pop(-1)
-            # cidx = self.kdflat[idx]
-            mark = self.kdflat[idx + 1]
-            if mark == -1:  # they are triangles
-                n = self.kdflat[idx + 2]
-                # print("triangle", idx, self.kdcmin[cidx], self.kdcmax[cidx])
-                print("triangle", idx, end="")
-                print(f" ({tag}) data#{n}", end=" ")
-                for i in range(n):
-                    print(self.kdflat[idx+3+i], end=" ")
-                print("")
-            else:
-                left = mark
-                right = self.kdflat[idx + 2]
-                mid = self.kdflat[idx + 3]
-                # lrd = self.kdflat[idx + 4]
-                # print("[node]", left, right, mid, self.kdcmin[cidx], self.kdcmax[cidx])
-                print("[node]", left, right, mid)
-                nlist.append((mid, 'M'))
-                nlist.append((right, 'R'))
-                nlist.append((left, 'L'))
+            subn = self.octree[idx].subn
+            print(f"[node] {idx} ({tag})", end=" ")
+            for i in range(8):
+                if subn[i] < 0:
+                    first = (-subn[i] - 1) >> 3
+                    count = ((-subn[i] - 1) & 7) + 1
+                    print(f"t{first}-{first + count - 1}", end=" ")
+                elif subn[i] > 0:
+                    print(f"n{subn[i]}", end=" ")
+                    nlist.append((subn[i], str(i)))
+            print("")
 
     @ti.func
     def _get_color(self, meshidx, alpha: float, beta: float):
@@ -889,130 +916,103 @@ class TriangleSoup:
 
     @ti.func
     def _check_ab(self, alpha, beta):
-        ans = 1
-        if alpha < 0.0 or beta < 0.0 or alpha + beta > 1.0:
-            ans = 0
-        return ans
+        return (alpha >= 0.0) & (beta >= 0.0) & (alpha + beta <= 1.0)
 
     @ti.func
-    def _iter_objects(self, ray, idx, time_min, time_max):
-        is_hit = 0
-        hit_point = ti.Vector([0.0, 0.0, 0.0])
-        hit_normal = ti.Vector([0.0, 1.0, 0.0])
-        is_inside = 0
-
-        hit_meshidx = -1
-        hit_alpha = -1.0
-        hit_beta = -1.0
-
-        _n = self.kdflat[idx + 2]
-        # print("iter", _n)
-        for _oi in range(_n):
-            meshidx = self.kdflat[idx+3+_oi]
-            item = self.meshes[meshidx]
-            # print("hit item", item.x)
-            rdn = ray.direction.dot(item.n)
-            if ti.abs(rdn) < 1e-5:
-                continue
-            # ray hit plane
-            t = item.n.dot(item.x - ray.origin) / \
-                item.n.dot(ray.direction)
-
-            if t > time_min and t < time_max:
-                p = ray.at(t)
-
-                alpha, beta = _parallelogram_alpha_beta(
-                    p - item.x, item.ax, item.bx, item.idetidx, item.idet)
-
-                if self._check_ab(alpha, beta):
-                    # in the triangle | paralleogram
-                    is_hit = 1
-                    hit_meshidx = meshidx
-                    hit_alpha = alpha
-                    hit_beta = beta
-                    time_max = t  # !! update
-                    hit_point = p
-                    if rdn > 0:
-                        hit_normal = -1 * item.n
-                        is_inside = 1
-                    # rdn < 0; outside
-                    else:
-                        hit_normal = item.n
-                        is_inside = 0
-
-        return is_hit, hit_meshidx, hit_alpha, hit_beta, time_max, hit_point, hit_normal, is_inside
+    def _hit_triangle(self, ray, meshidx, time_min, time_max):
+        """the leaf test, without branches; the hit point and the normal
+        are computed by the caller, only for the closest hit
+        """
+        item = self.meshes[meshidx]
+        alpha, beta, t, a = _moller_trumbore(ray, item.x, item.ax, item.bx)
+        # ti.abs(a) is too small: the ray is parallel to the plane
+        is_hit = (ti.abs(a) >= 1e-12) & (t > time_min) & (t < time_max) & \
+            self._check_ab(alpha, beta)
+        return is_hit, alpha, beta, t
 
     @ti.func
     def ray_intersect(self, ray, time_min: float, time_max: float):
+        """closest hit in the AABBTree; a stack based traversal of the 8-wide
+        nodes. It is large: every kernel that inlines it takes about 100 s
+        to compile on one CPU core
+        """
         is_hit = 0
         hit_point = ti.Vector([0.0, 0.0, 0.0])
         hit_normal = ti.Vector([0.0, 1.0, 0.0])
         is_inside = 0
 
-        idx = 0
-        flag, _ = ray_intersect_solid_box(
-            ray, self.kdcmin[0], self.kdcmax[0], time_min, time_max)
-
         hit_meshidx = -1
         hit_alpha = -1.0
         hit_beta = -1.0
 
-        while flag:
-            mark = self.kdflat[idx+1]
-            if mark < 0:  # triangles
-                flag = 0
-                info = self._iter_objects(ray, idx, time_min, time_max)
-                # and info[4] > time_min and info[4] < time_max:
-                if info[0] == 1:
-                    is_hit = 1
-                    hit_meshidx = info[1]
-                    hit_alpha = info[2]
-                    hit_beta = info[3]
-                    time_max = info[4]
-                    hit_point = info[5]
-                    hit_normal = info[6]
-                    is_inside = info[7]
-            else:  # objects
-                _l = mark
-                _r = self.kdflat[idx+2]
-                _m = self.kdflat[idx+3]
-
-                _li = self.kdflat[_l]
-                _ri = self.kdflat[_r]
-                _mi = self.kdflat[_m]
-
-                _hitm, _ = ray_intersect_solid_box(
-                    ray, self.kdcmin[_mi], self.kdcmax[_mi], time_min, time_max)
-                if _hitm == 1:
-                    # iter mid
-                    info = self._iter_objects(ray, _m, time_min, time_max)
-                    # and info[4] > time_min and info[4] < time_max:
-                    if info[0] == 1:
-                        is_hit = 1
-                        hit_meshidx = info[1]
-                        hit_alpha = info[2]
-                        hit_beta = info[3]
-                        time_max = info[4]
-                        hit_point = info[5]
-                        hit_normal = info[6]
-                        is_inside = info[7]
-
-                _hitl, _ = ray_intersect_solid_box(
-                    ray, self.kdcmin[_li], self.kdcmax[_li], time_min, time_max
-                )
-                _hitr, _ = ray_intersect_solid_box(
-                    ray, self.kdcmin[_ri], self.kdcmax[_ri], time_min, time_max
-                )
-
-                if _hitl == 1 and _hitr == 1:
-                    # we should iter both left and right
-                    idx = self.kdflat[idx+4]
-                elif _hitl == 1:
-                    idx = _l
-                elif _hitr == 1:
-                    idx = _r
-                else:  # not hit
-                    flag = 0
+        # stack of the nodes to visit, and their entry time
+        stack = ti.Vector.zero(ti.i32, BVH_STACK_SIZE)
+        stack_t = ti.Vector.zero(ti.f32, BVH_STACK_SIZE)
+        sp = 0
+
+        flag, _ = ray_intersect_solid_box(
+            ray, self.bbox[0], self.bbox[1], time_min, time_max)
+        if flag == 1:
+            stack[0] = 0
+            stack_t[0] = time_min
+            sp = 1
+
+        iters = 0
+        while sp > 0 and iters < BVH_MAX_ITERS:
+            iters += 1
+            sp -= 1
+            node = stack[sp]
+            if stack_t[sp] > time_max:
+                # a closer triangle was found after this node was pushed
+                continue
+
+            # no local copy of the node: u8 locals make taichi warn
+            # "Local store may lose precision"
+            subn = self.octree[node].subn
+            hits, tenter = ray_intersect_solid_box_x8(
+                ray, self.octree[node].origin, self.octree[node].scale,
+                self.octree[node].qmin.cast(ti.f32), self.octree[node].qmax.cast(ti.f32),
+                time_min, time_max)
+
+            keys = ti.Vector.zero(ti.f32, 8)
+            ids = ti.Vector.zero(ti.i32, 8)
+            for k in range(8):  # not static; only inline one triangle test
+                keys[k] = -1e30
+                if hits[k] == 1 and subn[k] < 0:  # a leaf of triangles
+                    first = (-subn[k] - 1) >> 3
+                    count = ((-subn[k] - 1) & 7) + 1
+                    for meshidx in range(first, first + count):
+                        info = self._hit_triangle(ray, meshidx, time_min, time_max)
+                        if info[0] == 1:
+                            is_hit = 1
+                            hit_meshidx = meshidx
+                            hit_alpha = info[1]
+                            hit_beta = info[2]
+                            time_max = info[3]
+                elif hits[k] == 1 and subn[k] > 0:  # nodes
+                    keys[k] = tenter[k]
+                    ids[k] = subn[k]
+
+            # the farthest first; so that the nearest is popped first
+            for i, j in ti.static(_SORT8_NETWORK):
+                if keys[i] < keys[j]:
+                    keys[i], keys[j] = keys[j], keys[i]
+                    ids[i], ids[j] = ids[j], ids[i]
+
+            for k in range(8):  # not static; smaller to compile
+                if ids[k] > 0 and sp < BVH_STACK_SIZE:
+                    stack[sp] = ids[k]
+                    stack_t[sp] = keys[k]
+                    sp += 1
+
+        if is_hit == 1:
+            # in the triangle | paralleogram
+            item = self.meshes[hit_meshidx]
+            hit_point = ray_at(ray, time_max)
+            hit_normal = item.bx.cross(item.ax).normalized()
+            # the ray hits the back side: inside
+            is_inside = ray.direction.dot(hit_normal) > 0
+            hit_normal = ti.select(is_inside, -1.0, 1.0) * hit_normal
 
         color = self._get_color(hit_meshidx, hit_alpha, hit_beta)
 
@@ -1023,7 +1023,7 @@ class TriangleSoup:
         for i in range(self.info[None]):
             fi = self.meshes[i]
             items.append(
-                f"x={fi.x}, ax={fi.ax}, bx={fi.bx}, n={fi.n}, material={fi.material}, color={fi.color}")
+                f"x={fi.x}, ax={fi.ax}, bx={fi.bx}, material={fi.material}, color={fi.color}")
         items = "\n  ".join(items)
         return f"""{self.__class__.__name__}(\n  {items})"""
 
@@ -1050,10 +1050,7 @@ class ParallelogramSoup(TriangleSoup):
     # only need to rewrite this function
     @ti.func
     def _check_ab(self, alpha, beta):
-        ans = 1
-        if alpha < 0.0 or beta < 0.0 or alpha > 1.0 or beta > 1.0:
-            ans = 0
-        return ans
+        return (alpha >= 0.0) & (beta >= 0.0) & (alpha <= 1.0) & (beta <= 1.0)
 
 
 @ti.data_oriented
@@ -1091,25 +1088,33 @@ class Box(ParallelogramSoup):
     """
 
     def __init__(self, a, x, b, c, material, texture=None, color=None, normal_out=True) -> None:
+        corners = [np.asarray([p[0], p[1], p[2]], dtype=np.float32)[None] for p in (a, x, b, c)]
+        vertex, faces = Box._mesh(*corners, normal_out)
+        super().__init__(vertex, faces, material, texture, color)
 
+    @staticmethod
+    def _mesh(a, x, b, c, normal_out=True):
+        """vertex and faces of boxes; a, x, b, c: (N, 3) arrays"""
         d = b + c - x
         e = a + c - x
         f = b + a - x
         # g = d + e - c
 
-        # print(x, a, b, c, d, e, f, g)
-        vertex = np.asarray([
-            [a[0], a[1], a[2], 0.0, 0.0, 0.0, 0.00, 0.75],
-            [x[0], x[1], x[2], 0.0, 0.0, 0.0, 0.00, 0.50],
-            [b[0], b[1], b[2], 0.0, 0.0, 0.0, 0.25, 0.50],
-            [c[0], c[1], c[2], 0.0, 0.0, 0.0, 0.00, 0.25],
-            [d[0], d[1], d[2], 0.0, 0.0, 0.0, 0.25, 0.25],
-            [e[0], e[1], e[2], 0.0, 0.0, 0.0, 0.75, 0.25],
-            [f[0], f[1], f[2], 0.0, 0.0, 0.0, 0.50, 0.50],
-        ], dtype=np.float32)
-
         # a x b c d e f
         # 0 1 2 3 4 5 6
+        st = np.asarray([
+            [0.00, 0.75],
+            [0.00, 0.50],
+            [0.25, 0.50],
+            [0.00, 0.25],
+            [0.25, 0.25],
+            [0.75, 0.25],
+            [0.50, 0.50],
+        ], dtype=np.float32)
+        n = a.shape[0]
+        vertex = np.zeros((n, 7, 8), dtype=np.float32)
+        vertex[:, :, 0:3] = np.stack([a, x, b, c, d, e, f], axis=1)
+        vertex[:, :, 6:8] = st
 
         if normal_out:
             faces = [[0, 1, 2],
@@ -1126,32 +1131,42 @@ class Box(ParallelogramSoup):
                      [0, 1, 3],
                      [5, 3, 4]]
 
-        faces = np.asarray(faces, dtype=np.int32)
-        super().__init__(vertex, faces, material, texture, color)
+        # 7 vertex per box
+        faces = np.asarray(faces, dtype=np.int32)[None] + \
+            7 * np.arange(n, dtype=np.int32)[:, None, None]
+        return vertex.reshape(-1, 8), faces.reshape(-1, 3)
 
     @staticmethod
-    def new(center, size, material, texture=None, color=None, normal_out=True):
+    def _corners(center, size):
+        """a, x, b, c of boxes; center, size: (N, 3) arrays"""
         halfs = size / 2.0
+        sign = np.asarray([
+            [-1, -1, 1],  # a
+            [1, -1, 1],  # x
+            [1, 1, 1],  # b
+            [1, -1, -1],  # c
+        ], dtype=np.float32)
+        return [center + s * halfs for s in sign]
 
-        x = ti.Vector([
-            center[0] + halfs[0],
-            center[1] - halfs[1],
-            center[2] + halfs[2]])
-        a = ti.Vector([
-            center[0] - halfs[0],
-            center[1] - halfs[1],
-            center[2] + halfs[2]])
-        b = ti.Vector([
-            center[0] + halfs[0],
-            center[1] + halfs[1],
-            center[2] + halfs[2]])
-        c = ti.Vector([
-            center[0] + halfs[0],
-            center[1] - halfs[1],
-            center[2] - halfs[2]])
-
+    @staticmethod
+    def new(center, size, material, texture=None, color=None, normal_out=True):
+        a, x, b, c = Box._corners(
+            np.asarray([center[0], center[1], center[2]], dtype=np.float32),
+            np.asarray([size[0], size[1], size[2]], dtype=np.float32))
         return Box(a, x, b, c, material, texture, color, normal_out)
 
+    @staticmethod
+    def new_batch(centers, sizes, material, texture=None, color=None, normal_out=True):
+        """many boxes in one ParallelogramSoup, i.e. one AABB tree
+
+        - centers: (N, 3)
+        - sizes: (N, 3), or (3,) for boxes of the same size
+        """
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        sizes = np.broadcast_to(np.asarray(sizes, dtype=np.float32), centers.shape)
+        vertex, faces = Box._mesh(*Box._corners(centers, sizes), normal_out)
+        return ParallelogramSoup(vertex, faces, material, texture, color)
+
 
 @ti.data_oriented
 class SphereSoup:
@@ -1161,12 +1176,14 @@ class SphereSoup:
 
         self.num_sphere = count
 
+        # SOA: the intersection loop only reads x and r2
         self.spheres = ti.Struct.field({
             "x": ti.types.vector(3, ti.f32),
             "r": ti.f32,
+            "r2": ti.f32,
             "material": ti.i32,
             "color": ti.types.vector(3, ti.f32),
-        }, count)
+        }, count, layout=ti.Layout.SOA)
 
         self.scount = 0
         self.material = material
@@ -1184,11 +1201,21 @@ class SphereSoup:
 
         self.spheres[self.scount].x = x
         self.spheres[self.scount].r = r
+        self.spheres[self.scount].r2 = r * r
         self.spheres[self.scount].material = material
         self.spheres[self.scount].color = color
 
         self.scount += 1
 
+    @ti.func
+    def _hit_closer(self, ray, idx, time_min, hit_time, hit_idx, is_inside):
+        """test sphere idx; keep the closer one of it and the hit so far"""
+        info = _sphere_hit(
+            self.spheres[idx].x, self.spheres[idx].r2, ray, time_min, hit_time)
+        # is_hit, hit_time, is_inside; a hit is always closer
+        return ti.select(info[0], info[1], hit_time), ti.select(info[0], idx, hit_idx), \
+            ti.select(info[0], info[2], is_inside)
+
     @ti.func
     def ray_intersect(self, ray, time_min, time_max):
         is_hit = 0
@@ -1199,19 +1226,22 @@ class SphereSoup:
         material = 0
         color = self.color
 
-        for idx in range(self.scount):
-            item = self.spheres[idx]
-
-            info = _sphere_hit(item.x, item.r, ray, time_min, hit_time)
-            # is_hit, hit_time, hit_point, hit_normal, is_inside
-
-            if info[0] == 0 or info[1] > hit_time:
-                continue
-            is_hit = info[0]
-            hit_time = info[1]
-            hit_point = info[2]
-            hit_normal = info[3]
-            is_inside = info[4]
+        hit_idx = -1
+        if ti.static(self.scount <= SPHERE_SOUP_UNROLL):
+            # a few spheres; unrolled, so the tests can be interleaved
+            for idx in ti.static(range(self.scount)):
+                hit_time, hit_idx, is_inside = self._hit_closer(
+                    ray, idx, time_min, hit_time, hit_idx, is_inside)
+        else:
+            for idx in range(self.scount):
+                hit_time, hit_idx, is_inside = self._hit_closer(
+                    ray, idx, time_min, hit_time, hit_idx, is_inside)
+
+        if hit_idx >= 0:
+            is_hit = 1
+            item = self.spheres[hit_idx]
+            hit_point = ray_at(ray, hit_time)
+            hit_normal = _sphere_normal(item.x, item.r, hit_point, is_inside)
             material = item.material
             color = item.color
 
@@ -1229,25 +1259,50 @@ class SphereSoup:
 
 @ti.data_oriented
 class Scene:
-    def __init__(self):
+    """All spheres are merged into one SphereSoup (self.spheres), so they
+    share one intersection loop; the other objects are inlined one by one.
+    """
+
+    def __init__(self, max_spheres=MAX_SPHERES):
         self.objList = []
         self.objName = []
+        self.spheres = SphereSoup(max_spheres)
+        # objects that are not in self.spheres
+        self.others = []
 
     def append(self, obj, name=None):
         if name is None:
             name = "obj%d" % len(self.objList)
         # print(name, obj)
-        new_name = True
         for i, n in enumerate(self.objName):
             if n != name:
                 continue
             print("overwrite", name)
             self.objList[i] = obj
-            new_name = False
-            break
-        if new_name:
-            self.objName.append(name)
-            self.objList.append(obj)
+            self._merge_objs()
+            return
+        self.objName.append(name)
+        self.objList.append(obj)
+        if not isinstance(obj, Sphere):
+            self.others.append(obj)
+        elif self.spheres.scount < self.spheres.num_sphere:
+            self.spheres.append(obj.center, obj.radius, obj.material, obj.color)
+        else:
+            self._merge_objs()
+
+    def _merge_objs(self):
+        """rebuild self.spheres and self.others from self.objList"""
+        n = sum(isinstance(obj, Sphere) for obj in self.objList)
+        if n > self.spheres.num_sphere:
+            # grow instead of dropping spheres; doubled to rebuild rarely
+            self.spheres = SphereSoup(max(n, 2 * self.spheres.num_sphere))
+        self.spheres.scount = 0
+        self.others = []
+        for obj in self.objList:
+            if isinstance(obj, Sphere):
+                self.spheres.append(obj.center, obj.radius, obj.material, obj.color)
+            else:
+                self.others.append(obj)
 
     def remove_obj(self, name):
         ni = -1
@@ -1259,10 +1314,12 @@ class Scene:
         if ni != -1:
             del self.objList[ni]
             del self.objName[ni]
+            self._merge_objs()
 
     def clear_objs(self):
         self.objList.clear()
         self.objName.clear()
+        self._merge_objs()
 
     @ti.func
     def ray_intersect(self, ray, time_min=1e-8, time_max=1e+8):
@@ -1273,8 +1330,18 @@ class Scene:
         material = 0
         color = ti.Vector([0.0, 0.0, 0.0])
 
-        for i in ti.static(range(len(self.objList))):
-            info = self.objList[i].ray_intersect(ray, time_min, time_max)
+        sinfo = self.spheres.ray_intersect(ray, time_min, time_max)
+        if sinfo[0] == 1 and sinfo[1] > time_min and sinfo[1] < time_max:
+            is_hit = 1
+            time_max = sinfo[1]
+            hit_point = sinfo[2]
+            hit_normal = sinfo[3]
+            material = sinfo[4]
+            color = sinfo[5]
+            is_inside = sinfo[6]
+
+        for i in ti.static(range(len(self.others))):
+            info = self.others[i].ray_intersect(ray, time_min, time_max)
             # print("hit obj", i, info, time_max)
             if info[0] == 1 and info[1] > time_min and info[1] < time_max:
                 is_hit = 1
@@ -1291,86 +1358,238 @@ class Scene:
 @ti.data_oriented
 class Camera:
     # codes are copied from course examples
+
+    # row of self.cam
+    ORIGIN = 0
+    # rows of self.cam_dir, directions
+    DIR0 = 0  # the direction of the ray at (u, v) = (0, 0), to the lower left corner
+    HORIZ = 1
+    VERT = 2
+
     def __init__(self, fov=60, aspect_ratio=1.0) -> None:
         # Camera parameters
-        self.lookfrom = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.lookat = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.vup = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.fov = fov
-        self.aspect_ratio = aspect_ratio
+        self.set_fov(fov, aspect_ratio)
 
-        self.cam_lower_left_corner = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.cam_horizontal = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.cam_vertical = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self.cam_origin = ti.Vector.field(3, dtype=ti.f32, shape=())
+        # origin; the direction to the lower left corner, horizontal and
+        # vertical; see ORIGIN, DIR0, ... padded to 4 with w = 0, 16 bytes
+        # for the origin row and 8 for a direction row. The directions only
+        # steer the primary rays and are kept in f16; the origin stays f32
+        # for the intersection precision
+        self.cam = ti.Vector.field(4, dtype=ti.f32, shape=(1,))
+        self.cam_dir = ti.Vector.field(4, dtype=ti.f16, shape=(3,))
+        # per-column and per-row directions of a fixed pixel grid; see set_grid
+        self.col_off = None
+        self.row_off = None
 
-        self.set_look_from(7.0, 2.0, 2.0)
-        self.set_look_at(-1.0, 1.0, -0.7)
-        self.set_vup(0.0, 0.0, 1.0)
+        self.set_camera((7.0, 2.0, 2.0), (-1.0, 1.0, -0.7), (0.0, 0.0, 1.0))
 
-        self.reset()
 
+    # lookat / lookfrom and vup are Python tuples; the kernels only read
+    # the basis that reset() computes from them
 
     def set_look_at(self, x: float, y: float, z: float):
-        self.lookat[None] = [x, y, z]
+        self._lookat_py = (x, y, z)
 
     def set_look_from(self, x: float, y: float, z: float):
-        self.lookfrom[None] = [x, y, z]
+        self._lookfrom_py = (x, y, z)
 
     def set_look_at_delta(self, x: float = 0, y: float = 0, z: float= 0):
-        la = self.lookat[None]
-        self.lookat[None] = [la[0] + x, la[1] + y, la[2] + z]
+        la = self._lookat_py
+        self.set_look_at(la[0] + x, la[1] + y, la[2] + z)
 
     def set_look_from_delta(self, x: float=0, y: float=0, z: float=0):
-        lf = self.lookfrom[None]
-        self.lookfrom[None] = [lf[0] + x, lf[1] + y, lf[2] + z]
+        lf = self._lookfrom_py
+        self.set_look_from(lf[0] + x, lf[1] + y, lf[2] + z)
 
     def look_at(self):
-        a = self.lookat[None]
-        return a[0], a[1], a[2]
+        return self._lookat_py
 
     def look_from(self):
-        a = self.lookfrom[None]
-        return a[0], a[1], a[2]
+        return self._lookfrom_py
+
+    def set_fov(self, fov: float, aspect_ratio: float = None):
+        """vertical field of view in degrees; takes effect on reset()"""
+        self.fov = fov
+        if aspect_ratio is not None:
+            self.aspect_ratio = aspect_ratio
+        self.half_height = math.tan(math.radians(fov) / 2.0)
+        self.half_width = self.aspect_ratio * self.half_height
 
     def set_vup(self, x: float, y: float, z: float):
-        vup = ti.Vector([x, y, z])
-        self.vup[None] = vup.normalized()
+        vup = np.asarray([x, y, z], dtype=np.float64)
+        self._vup_py = tuple((vup / np.linalg.norm(vup)).tolist())
+
+    def set_camera(self, lookfrom, lookat, vup=None):
+        """set lookfrom, lookat and optionally vup (x, y, z) and reset() once"""
+        self.set_look_from(*lookfrom)
+        self.set_look_at(*lookat)
+        if vup is not None:
+            self.set_vup(*vup)
+        self.reset()
 
-    @ti.kernel
     def reset(self):
-        theta = self.fov * (math.pi / 180.0)
-        half_height = ti.tan(theta / 2.0)
-        half_width = self.aspect_ratio * half_height
-        self.cam_origin[None] = self.lookfrom[None]
-        w = (self.lookfrom[None] - self.lookat[None]).normalized()
-        u = (self.vup[None].cross(w)).normalized()
-        v = w.cross(u)
-        self.cam_lower_left_corner[None] = ti.Vector(
-            [-half_width, -half_height, -1.0])
-        self.cam_lower_left_corner[
-            None] = self.cam_origin[None] - half_width * u - half_height * v - w
-        self.cam_horizontal[None] = 2 * half_width * u
-        self.cam_vertical[None] = 2 * half_height * v
-
-    @ti.pyfunc
+        """update the camera basis from lookfrom, lookat and vup; on the host"""
+        lookfrom = np.asarray(self._lookfrom_py, dtype=np.float64)
+        w = lookfrom - np.asarray(self._lookat_py, dtype=np.float64)
+        w /= np.linalg.norm(w)
+        u = np.cross(np.asarray(self._vup_py, dtype=np.float64), w)
+        u /= np.linalg.norm(u)
+        v = np.cross(w, u)
+        cam = np.zeros((1, 4), dtype=np.float32)
+        cam_dir = np.zeros((3, 4), dtype=np.float16)
+        cam[self.ORIGIN, :3] = lookfrom
+        cam_dir[self.DIR0, :3] = -self.half_width * u - self.half_height * v - w
+        cam_dir[self.HORIZ, :3] = 2 * self.half_width * u
+        cam_dir[self.VERT, :3] = 2 * self.half_height * v
+        self.cam.from_numpy(cam)
+        self.cam_dir.from_numpy(cam_dir)
+        # the host copies follow the f16 rounding of the kernels
+        cam_dir = cam_dir.astype(np.float32)
+        # the same basis on the host: origin, dir0, horizontal and vertical
+        self.basis = (cam[self.ORIGIN, :3],) + tuple(
+            cam_dir[k, :3] for k in (self.DIR0, self.HORIZ, self.VERT))
+        if self.col_off is not None:
+            self._fill_grid(cam_dir)
+
+    def set_grid(self, width: int, height: int):
+        """allocate the direction tables of a width x height pixel grid for
+        generate_grid_rays; reset() keeps them up to date
+        """
+        self.col_off = ti.Vector.field(3, dtype=ti.f32, shape=(width,))
+        self.row_off = ti.Vector.field(3, dtype=ti.f32, shape=(height,))
+        self._fill_grid(self.cam_dir.to_numpy().astype(np.float32))
+
+    def _fill_grid(self, cam_dir):
+        # the direction at the center of pixel (i, j) is col_off[i] + row_off[j];
+        # dir0 is folded into the columns
+        width, height = self.col_off.shape[0], self.row_off.shape[0]
+        u = (np.arange(width, dtype=np.float32) + 0.5) / width
+        v = (np.arange(height, dtype=np.float32) + 0.5) / height
+        self.col_off.from_numpy(cam_dir[self.DIR0, :3] + u[:, None] * cam_dir[self.HORIZ, :3])
+        self.row_off.from_numpy(v[:, None] * cam_dir[self.VERT, :3])
+
+    @ti.func
+    def load_basis(self):
+        """origin, dir0, horizontal and vertical as f32 vec4s, each field row
+        loaded once; outside of a pixel loop it hoists the loads out of it
+        """
+        return (self.cam[self.ORIGIN], self.cam_dir[self.DIR0].cast(ti.f32),
+                self.cam_dir[self.HORIZ].cast(ti.f32), self.cam_dir[self.VERT].cast(ti.f32))
+
+    @ti.func
     def get_ray(self, u, v):
-        return Ray(self.cam_origin[None], self.cam_lower_left_corner[None] + u * self.cam_horizontal[None] + v * self.cam_vertical[None] - self.cam_origin[None])
+        """origin and direction (not normalized) of the ray at (u, v);
+        new_ray(origin, direction) makes a Ray of them.
+        In Python scope use get_ray_numpy(u, v)
+        """
+        origin, dir0, horiz, vert = self.load_basis()
+        return Camera.get_ray_static(origin, dir0, horiz, vert, u, v)
+
+    def get_ray_numpy(self, u: float, v: float):
+        """get_ray on the host; numpy arrays origin and direction (not normalized)"""
+        origin, dir0, horiz, vert = self.basis
+        return origin.copy(), dir0 + u * horiz + v * vert
+
+    @staticmethod
+    @ti.func
+    def get_ray_static(origin, dir0, horiz, vert, u, v):
+        """get_ray with the basis given as values, e.g. kernel arguments or
+        load_basis(); vec4 rows are cut back to vec3
+        """
+        direction = dir0 + u * horiz + v * vert
+        return (ti.Vector([origin[0], origin[1], origin[2]]),
+                ti.Vector([direction[0], direction[1], direction[2]]))
+
+    def generate_primary_rays(self, origins, dirs, inv_w: float, inv_h: float):
+        """fill origins[i, j] and dirs[i, j] (normalized) with a jittered
+        primary ray of pixel (i, j); two vector fields of the canvas shape,
+        inv_w = 1 / width, inv_h = 1 / height
+        """
+        basis = (ti.Vector(b.tolist()) for b in self.basis)
+        self._generate_primary_rays(origins, dirs, inv_w, inv_h, *basis)
+
+    def generate_grid_rays(self, origins, dirs):
+        """fill origins[i, j] and dirs[i, j] (normalized) with the ray through
+        the center of pixel (i, j), no jitter; the shape of the fields is the
+        one given to set_grid
+        """
+        assert self.col_off is not None, "call set_grid(width, height) first"
+        assert dirs.shape == (self.col_off.shape[0], self.row_off.shape[0])
+        self._generate_grid_rays(origins, dirs, self.col_off, self.row_off, ti.Vector(self.basis[0].tolist()))
+
+    def generate_grid_rays_numpy(self, width: int, height: int):
+        """the rays of generate_grid_rays for a width x height grid computed
+        on the host; numpy arrays origins and dirs of shape (width, height, 3)
+        """
+        origin, dir0, horiz, vert = self.basis
+        u = (np.arange(width, dtype=np.float32) + 0.5) / width
+        v = (np.arange(height, dtype=np.float32) + 0.5) / height
+        dirs = (dir0 + u[:, None] * horiz)[:, None, :] + (v[:, None] * vert)[None, :, :]
+        dirs /= np.linalg.norm(dirs, axis=-1, keepdims=True)
+        return np.broadcast_to(origin, dirs.shape), dirs
+
+    @ti.kernel
+    def _generate_grid_rays(self, origins: ti.template(), dirs: ti.template(), col_off: ti.template(),
+                            row_off: ti.template(), origin: ti.types.vector(3, ti.f32)):
+        # two table loads and an add per ray; the tables are arguments so
+        # that a new set_grid does not leave a stale field in a compiled kernel
+        ti.loop_config(block_dim=256)
+        for i, j in dirs:
+            origins[i, j] = origin
+            dirs[i, j] = (col_off[i] + row_off[j]).normalized()
+
+    @ti.kernel
+    def _generate_primary_rays(self, origins: ti.template(), dirs: ti.template(), inv_w: float, inv_h: float,
+                               origin: ti.types.vector(3, ti.f32), dir0: ti.types.vector(3, ti.f32),
+                               horiz: ti.types.vector(3, ti.f32), vert: ti.types.vector(3, ti.f32)):
+        # the basis are kernel arguments, the same for all the pixels;
+        # no field loads per ray
+        ti.loop_config(block_dim=256)
+        for i, j in dirs:
+            u = (float(i) + ti.random()) * inv_w
+            v = (float(j) + ti.random()) * inv_h
+            o, d = Camera.get_ray_static(origin, dir0, horiz, vert, u, v)
+            origins[i, j] = o
+            dirs[i, j] = d.normalized()
 
 
 @ti.kernel
 def render(camera: ti.template(), canvas: ti.template(), scene: ti.template(), samples_per_pixel: float, max_depth: int):
     image_width, image_height = canvas.shape
     # print(image_width, image_height)
+    # the camera rows are loaded once, not per pixel
+    cam_origin, dir0, horiz, vert = camera.load_basis()
     for i, j in canvas:
         cc = ti.Vector([0.0, 0.0, 0.0])
         u = (float(i) + ti.random()) / image_width
         v = (float(j) + ti.random()) / image_height
-        ray = camera.get_ray(u, v)
+        origin, direction = Camera.get_ray_static(cam_origin, dir0, horiz, vert, u, v)
+        ray = new_ray(origin, direction)
         for _ in range(samples_per_pixel):
             cc += ray_color(ray, scene, max_depth)
         canvas[i, j] += cc / samples_per_pixel
 
+
+def profile(camera, canvas, scene, samples_per_pixel, max_depth, n_frames=10):
+    """print the kernel profiler trace of n_frames of primary ray generation
+    and render(), to see which of them the frame time goes to; opt-in,
+    needs ti.init(kernel_profiler=True). render() accumulates into canvas
+    """
+    origins = ti.Vector.field(3, dtype=ti.f32, shape=canvas.shape)
+    dirs = ti.Vector.field(3, dtype=ti.f32, shape=canvas.shape)
+    inv_w, inv_h = 1.0 / canvas.shape[0], 1.0 / canvas.shape[1]
+    # compile outside of the profiled frames
+    camera.generate_primary_rays(origins, dirs, inv_w, inv_h)
+    render(camera, canvas, scene, samples_per_pixel, max_depth)
+    ti.sync()
+    ti.profiler.clear_kernel_profiler_info()
+    for _ in range(n_frames):
+        camera.generate_primary_rays(origins, dirs, inv_w, inv_h)
+        ti.sync()
+        render(camera, canvas, scene, samples_per_pixel, max_depth)
+        ti.sync()
+    ti.profiler.print_kernel_profiler_info('trace')
+
 # return info
 # 0,      1,        2,         3,          4,        5,     6
 # is_hit, hit_time, hit_point, hit_normal, material, color, is_inside
@@ -1387,7 +1606,7 @@ def ray_color(ray, scene, max_depth: int):
         if ti.random() > p_RR:
             # print("break p_RR, depth", n)
             break
-        info = scene.ray_intersect(Ray(scattered_origin, scattered_direction))
+        info = scene.ray_intersect(new_ray(scattered_origin, scattered_direction))
         is_hit, hit_time, hit_point, hit_normal, material, color, is_inside = info
         if is_hit == 0:
             break
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import taichi as ti
+
+import Scene
+from plyread2 import NPLYReader
+
+MESH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mesh")
+
+
+def _leaf_ranges(subn):
+    """[first, first + count) of every leaf in subn (N, 8)"""
+    code = -subn[subn < 0] - 1
+    return [(first, first + count) for first, count in zip(code >> 3, (code & 7) + 1)]
+
+
+class TestAABBTree(unittest.TestCase):
+    """host-side invariants of the AABB tree of TriangleSoup"""
+
+    @classmethod
+    def setUpClass(cls):
+        ti.init(arch=ti.cpu, dynamic_index=True)
+        cls.cache_dir = Scene.BVH_CACHE_DIR
+        Scene.BVH_CACHE_DIR = None
+
+        ply = NPLYReader(os.path.join(MESH_DIR, "cristal.ply"))
+        cls.vertex, cls.faces = ply.vertex, ply.faces
+        rng = np.random.default_rng(0)
+        centers = rng.uniform(-5.0, 5.0, (50, 3))
+        # boxes with a face at 0, no margin from a relative rounding
+        centers[:10, 2] = 0.5
+        cls.boxes = Scene.Box.new_batch(centers, (1.0, 1.0, 1.0), Scene.M_diffuse)
+
+        cls.trees = {}
+        for name, vertex, faces in [
+                ("cristal", cls.vertex, cls.faces),
+                ("boxes", cls.boxes.vertex.to_numpy(), cls.boxes.faces.to_numpy())]:
+            aabb = Scene.AABBTree(Scene.TriangleSoup._init_meshes(vertex, faces))
+            aabb.build_tree()
+            cls.trees[name] = aabb
+
+    @classmethod
+    def tearDownClass(cls):
+        Scene.BVH_CACHE_DIR = cls.cache_dir
+
+    def test_leaves(self):
+        """every triangle is in exactly one leaf"""
+        for name, aabb in self.trees.items():
+            with self.subTest(name):
+                tree = aabb.to_numpy()
+                ranges = _leaf_ranges(tree["subn"])
+                for first, last in ranges:
+                    self.assertLessEqual(last - first, Scene.BVH_MAX_LEAF)
+                covered = np.concatenate([np.arange(first, last) for first, last in ranges])
+                np.testing.assert_array_equal(np.sort(covered), np.arange(aabb.count))
+                np.testing.assert_array_equal(np.sort(tree["indices"]), np.arange(aabb.count))
+
+    def test_quantized_boxes(self):
+        """each dequantized child box contains its original box"""
+        for name, aabb in self.trees.items():
+            with self.subTest(name):
+                tree = aabb.to_numpy()
+                valid = tree["subn"] != 0
+                origin, scale = tree["origin"][:, None], tree["scale"][:, None]
+                lo = origin + scale * tree["qmin"].astype(np.float32)
+                hi = origin + scale * tree["qmax"].astype(np.float32)
+                self.assertTrue((lo <= aabb.node_cmin)[valid].all())
+                self.assertTrue((hi >= aabb.node_cmax)[valid].all())
+
+    def test_cache(self):
+        """a cache hit reproduces the octree of the build"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            Scene.BVH_CACHE_DIR = cache_dir
+            try:
+                built = Scene.TriangleSoup(self.vertex, self.faces, Scene.M_diffuse)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                cached = Scene.TriangleSoup(self.vertex, self.faces, Scene.M_diffuse)
+            finally:
+                Scene.BVH_CACHE_DIR = None
+        expected, actual = built.octree.to_numpy(), cached.octree.to_numpy()
+        for k in expected:
+            np.testing.assert_array_equal(actual[k], expected[k], err_msg=k)
+        np.testing.assert_array_equal(cached.faces.to_numpy(), built.faces.to_numpy())
+        self.assertEqual(cached.levels, built.levels)
+
+    def test_refit(self):
+        """a refit right after the build reproduces the octree"""
+        for soup in (Scene.TriangleSoup(self.vertex, self.faces, Scene.M_diffuse), self.boxes):
+            with self.subTest(type(soup).__name__):
+                expected, bbox = soup.octree.to_numpy(), soup.bbox.to_numpy()
+                soup.refit()
+                actual = soup.octree.to_numpy()
+                for k in ("subn", "qmin", "qmax", "origin"):
+                    np.testing.assert_array_equal(actual[k], expected[k], err_msg=k)
+                # the same sum, in another order
+                np.testing.assert_allclose(actual["scale"], expected["scale"], rtol=1e-6)
+                np.testing.assert_array_equal(soup.bbox.to_numpy(), bbox)
+
+
+class TestCamera(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ti.init(arch=ti.cpu, dynamic_index=True)
+
+    def test_grid_rays(self):
+        """generate_grid_rays_numpy matches generate_grid_rays"""
+        width, height = 64, 48
+        camera = Scene.Camera()
+        camera.set_grid(width, height)
+        camera.set_camera((7.28, -4.16, 4.16), (-2.28, 0.57, 0.04))
+        origins = ti.Vector.field(3, ti.f32, (width, height))
+        dirs = ti.Vector.field(3, ti.f32, (width, height))
+        camera.generate_grid_rays(origins, dirs)
+
+        expected_origins, expected_dirs = camera.generate_grid_rays_numpy(width, height)
+        np.testing.assert_array_equal(origins.to_numpy(), expected_origins)
+        np.testing.assert_allclose(dirs.to_numpy(), expected_dirs, atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
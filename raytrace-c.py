@@ -8,7 +8,9 @@ from plyread2 import NPLYReader
 
 # ti.init(excepthook=True)
 # ti.init(debug=True, kernel_profiler=True)
-ti.init()
+# dynamic_index: TriangleSoup keeps its traversal stack in a local vector
+# offline_cache: reuse the compiled kernels of the previous runs
+ti.init(dynamic_index=True, offline_cache=True, offline_cache_file_path=".ti_cache")
 
 # Canvas
 aspect_ratio = 1.0
@@ -26,7 +28,8 @@ def render_01(camera: ti.template()):
     for i, j in canvas:
         u = (float(i) + ti.random()) / image_width
         v = (float(j) + ti.random()) / image_height
-        ray = camera.get_ray(u, v)
+        origin, direction = camera.get_ray(u, v)
+        ray = Scene.new_ray(origin, direction)
         color = ray_color_01(ray)
         canvas[i, j] += color
 
@@ -67,9 +70,7 @@ scene.append(Scene.TriangleSoup(
 canvas.fill(0)
 
 camera = Scene.Camera()
-camera.set_look_from(7.28, -4.16, 4.16)
-camera.set_look_at(-2.28, 0.57, 0.04)
-camera.reset()
+camera.set_camera((7.28, -4.16, 4.16), (-2.28, 0.57, 0.04))
 
 gui = ti.GUI("ray tracing", res=(image_width, image_height))
 # gui.fps_limit = 3
@@ -92,12 +93,13 @@ while gui.running:
         elif e.key == ti.GUI.LMB:
             if e.type == ti.GUI.PRESS:
                 u, v = gui.get_cursor_pos()
-                clicked_loc = camera.get_ray(u, v).direction.to_numpy()
+                _, direction = camera.get_ray_numpy(u, v)
+                clicked_loc = direction / np.linalg.norm(direction)
             else:
                 u, v = gui.get_cursor_pos()
                 # print("click", u, v)
-                ray = camera.get_ray(u,v)
-                dir = clicked_loc - ray.direction.to_numpy()
+                _, direction = camera.get_ray_numpy(u, v)
+                dir = clicked_loc - direction / np.linalg.norm(direction)
                 dir *= 5.0
                 camera.set_look_at_delta(dir[0], dir[1], dir[2])
 
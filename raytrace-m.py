@@ -7,7 +7,9 @@ from plyread2 import NPLYReader
 
 # ti.init(excepthook=True)
 # ti.init(debug=True, kernel_profiler=True)
-ti.init()
+# dynamic_index: TriangleSoup keeps its traversal stack in a local vector
+# offline_cache: reuse the compiled kernels of the previous runs
+ti.init(dynamic_index=True, offline_cache=True, offline_cache_file_path=".ti_cache")
 
 # Canvas
 aspect_ratio = 1.0
@@ -25,7 +27,8 @@ def render_01(camera: ti.template()):
     for i, j in canvas:
         u = (float(i) + ti.random()) / image_width
         v = (float(j) + ti.random()) / image_height
-        ray = camera.get_ray(u, v)
+        origin, direction = camera.get_ray(u, v)
+        ray = Scene.new_ray(origin, direction)
         color = ray_color_01(ray)
         canvas[i, j] += color
 
@@ -73,9 +76,7 @@ scene.append(Scene.TriangleSoup(
 canvas.fill(0)
 
 camera = Scene.Camera()
-camera.set_look_from(16.0, -2.0, 10.0)
-camera.set_look_at(0.0, 0.0, 0.0)
-camera.reset()
+camera.set_camera((16.0, -2.0, 10.0), (0.0, 0.0, 0.0))
 
 gui = ti.GUI("ray tracing", res=(image_width, image_height))
 # gui.fps_limit = 3